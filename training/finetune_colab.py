@@ -18,22 +18,58 @@ Training takes ~1-2 hours on a free T4 GPU for 30-50 examples.
 
 # !pip install -q torch transformers datasets peft accelerate bitsandbytes
 # !pip install -q trl wandb   # trl for SFTTrainer, wandb optional for logging
+# !pip install -q orjson       # Fast JSONL parsing in CELL 3
+# !pip install -q hf_transfer  # Rust-based Hub downloads (enabled in CELL 2)
+# !pip install -q unsloth      # Fused QLoRA kernels (used when USE_UNSLOTH = True)
+# !pip install -q liger-kernel # Fused Triton ops for the non-Unsloth path (USE_LIGER)
+# !pip install -q flash-attn --no-build-isolation  # Optional, Ampere+ only (A100/L4)
 
 # ═══════════════════════════════════════════════════════════════════════
 # CELL 2: Imports & Config
 # ═══════════════════════════════════════════════════════════════════════
 
-import json
+import hashlib
+import importlib.util
+import inspect
+import os
+import shutil
+import subprocess
+import sys
+
+# On Colab, keep the Hugging Face cache on Google Drive so the model isn't
+# re-downloaded after every runtime restart. Must run before transformers /
+# datasets are imported, since they read these at import time.
+try:
+    from google.colab import drive
+
+    drive.mount('/content/drive')
+    os.environ['HF_HOME'] = '/content/drive/MyDrive/hf_cache'
+except ImportError:
+    pass
+if importlib.util.find_spec("hf_transfer"):
+    os.environ['HF_HUB_ENABLE_HF_TRANSFER'] = '1'
+
+# Unsloth's fused NF4/RoPE/attention kernels and hand-written LoRA backward.
+# Set to False to fall back to the stock transformers + PEFT path. Unsloth
+# patches transformers/peft/trl on import, so it has to be imported first.
+USE_UNSLOTH = True
+if USE_UNSLOTH:
+    from unsloth import FastLanguageModel
+
+import numpy as np
+import orjson
 import torch
 from pathlib import Path
-from datasets import Dataset
+from datasets import Dataset, load_from_disk
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
+    DataCollatorForSeq2Seq,
     TrainingArguments,
+    default_data_collator,
 )
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+from peft import LoraConfig, get_peft_model
 from trl import SFTTrainer
 
 # ── Configuration ──────────────────────────────────────────────────
@@ -43,20 +79,59 @@ MODEL_NAME = "deepseek-ai/deepseek-coder-1.3b-instruct"
 
 TRAINING_FILE = "training.jsonl"  # Upload this to Colab
 OUTPUT_DIR = "./react-testgen-lora"
-MERGED_DIR = "./react-testgen-merged"
+# The merged model is only an intermediate for GGUF conversion, so keep it on
+# tmpfs (RAM-backed) when there's one, skipping a slow disk write + re-read.
+MERGED_DIR = "/dev/shm/react-testgen-merged" if Path("/dev/shm").is_dir() else "./react-testgen-merged"
+GGUF_FILE = "react-testgen.gguf"
+
+# "adapter": skip the merge in CELL 8 and export a Q4_K_M base + LoRA adapter as
+# separate GGUFs, applied at load time (Ollama ADAPTER / llama.cpp --lora).
+# The base GGUF only changes with MODEL_NAME, so it's cached on Drive if mounted.
+# "merged": merge in CELL 8 and export a single Q4_K_M GGUF.
+EXPORT_MODE = "adapter"
+GGUF_CACHE_DIR = "/content/drive/MyDrive" if Path("/content/drive/MyDrive").is_dir() else "."
+BASE_GGUF_FILE = f"{GGUF_CACHE_DIR}/{MODEL_NAME.split('/')[-1]}-Q4_K_M.gguf"
+ADAPTER_GGUF_FILE = "react-testgen-lora.gguf"
+TOKENIZED_DIR = "./react-testgen-tokenized"  # Arrow caches of the raw + tokenized data
 
 # Training hyperparams (tuned for small datasets of 30-100 examples)
 EPOCHS = 4              # More epochs for small datasets
 BATCH_SIZE = 1          # Keep at 1 for free Colab T4 (16GB VRAM)
 GRADIENT_ACCUM = 4      # Effective batch size = 1 * 4 = 4
 LEARNING_RATE = 2e-4    # Standard for LoRA
-MAX_SEQ_LENGTH = 4096   # Covers most component+test pairs
+MAX_SEQ_LENGTH = 4096   # Upper bound; CELL 4 sizes block_size to fit the dataset
 LORA_R = 16             # LoRA rank (higher = more capacity)
 LORA_ALPHA = 32         # LoRA scaling
 LORA_DROPOUT = 0.05
+PACKING = True          # Pack short examples into full block_size blocks
+RESPONSE_TEMPLATE = "<|assistant|>\n"  # Loss is computed only on tokens after this
+
+# Mixed-precision dtype, used for both autocast and the 4-bit matmul compute.
+# Ampere+ (A100/L4/RTX 30xx+) supports bf16; T4 only has fp16. Checked by
+# compute capability, since is_bf16_supported() also counts emulated bf16.
+COMPUTE_DTYPE = "bf16" if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else "fp16"
+TORCH_DTYPE = torch.bfloat16 if COMPUTE_DTYPE == "bf16" else torch.float16
+
+# Memory-efficient attention instead of materializing the S×S score matrix.
+# FlashAttention-2 needs Ampere+; T4 uses PyTorch SDPA's mem-efficient kernel.
+ATTN_IMPLEMENTATION = (
+    "flash_attention_2"
+    if COMPUTE_DTYPE == "bf16" and importlib.util.find_spec("flash_attn")
+    else "sdpa"
+)
+
+# Liger's fused RMSNorm/SwiGLU/RoPE + chunked linear-cross-entropy (avoids
+# materializing the full B×S×V logits). Only used when USE_UNSLOTH is False,
+# since Unsloth already ships equivalent kernels.
+USE_LIGER = True
+# Compile the LoRA-wrapped model with Inductor. Also HF path only: Unsloth's
+# patched kernels don't compose with Dynamo.
+USE_TORCH_COMPILE = True
 
 print(f"🔧 Config: {MODEL_NAME}")
 print(f"   Epochs: {EPOCHS}, LR: {LEARNING_RATE}, LoRA r={LORA_R}")
+attention_label = "Unsloth kernels" if USE_UNSLOTH else ATTN_IMPLEMENTATION  # Unsloth picks its own
+print(f"   Compute dtype: {COMPUTE_DTYPE}, Attention: {attention_label}, Unsloth: {USE_UNSLOTH}")
 print(f"   GPU: {torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'None'}")
 print(f"   VRAM: {torch.cuda.get_device_properties(0).total_mem / 1e9:.1f} GB" if torch.cuda.is_available() else "")
 
@@ -65,92 +140,277 @@ print(f"   VRAM: {torch.cuda.get_device_properties(0).total_mem / 1e9:.1f} GB" i
 # CELL 3: Load & Prepare Dataset
 # ═══════════════════════════════════════════════════════════════════════
 
+def format_example(data):
+    """Convert one JSONL record to a ChatML formatted string."""
+    # Format as ChatML (DeepSeek's native format)
+    parts = [f"<|{msg['role']}|>\n{msg['content']}\n" for msg in data['messages']]
+    parts.append("<|end|>")
+    return {"text": "".join(parts)}
+
+
 def load_training_data(filepath):
-    """Load JSONL and convert to ChatML formatted strings."""
-    examples = []
-    with open(filepath, 'r') as f:
+    """Stream JSONL records as ChatML formatted examples."""
+    with open(filepath, 'rb') as f:
         for line in f:
-            if not line.strip():
-                continue
-            data = json.loads(line)
-            messages = data['messages']
-
-            # Format as ChatML (DeepSeek's native format)
-            formatted = ""
-            for msg in messages:
-                role = msg['role']
-                content = msg['content']
-                if role == 'system':
-                    formatted += f"<|system|>\n{content}\n"
-                elif role == 'user':
-                    formatted += f"<|user|>\n{content}\n"
-                elif role == 'assistant':
-                    formatted += f"<|assistant|>\n{content}\n"
-
-            formatted += "<|end|>"
-            examples.append({"text": formatted})
-
-    return examples
-
-# Load data
-raw_data = load_training_data(TRAINING_FILE)
-dataset = Dataset.from_list(raw_data)
+            if line.strip():
+                yield format_example(orjson.loads(line))
+
+
+def tokenize_with_labels(batch, tokenizer):
+    """Tokenize ChatML text, masking the system/user prompt out of the loss.
+
+    Nothing is truncated here: cutting from the right would drop the response,
+    the only labelled part, so over-long examples are filtered out in CELL 4.
+    """
+    encoded = tokenizer(batch["text"], return_offsets_mapping=True)
+    labels = []
+    for text, ids, offsets in zip(batch["text"], encoded["input_ids"], encoded["offset_mapping"]):
+        marker = text.rfind(RESPONSE_TEMPLATE)
+        if marker == -1:
+            # No assistant turn: nothing to learn, mask it fully (dropped in CELL 4)
+            labels.append([-100] * len(ids))
+            continue
+        response_start = marker + len(RESPONSE_TEMPLATE)
+        labels.append([tok if start >= response_start else -100 for tok, (start, _) in zip(ids, offsets)])
+    return {
+        "input_ids": encoded["input_ids"],
+        "attention_mask": encoded["attention_mask"],
+        "labels": labels,
+    }
+
+
+def pack_sequences(batch, eos_token_id, pad_token_id, block_size):
+    """Pack whole tokenized examples, EOS-separated, into rows of block_size tokens.
+
+    position_ids restart at 0 for every example and no attention_mask is
+    emitted; only FlashAttention-2 turns those restarts into per-example
+    attention (sdpa and Unsloth attend across the whole row), so CELL 4 packs
+    only on that path. Each row's tail is one padding segment with no labels,
+    so every row is exactly block_size long.
+    """
+    rows, row, row_length = [], [], 0
+    for ids, labels in zip(batch["input_ids"], batch["labels"]):
+        example = (ids + [eos_token_id], labels + [eos_token_id])
+        if row and row_length + len(example[0]) > block_size:
+            rows.append(row)
+            row, row_length = [], 0
+        row.append(example)
+        row_length += len(example[0])
+    if row:
+        rows.append(row)
+
+    packed = {"input_ids": [], "labels": [], "position_ids": []}
+    for row in rows:
+        ids = [tok for example_ids, _ in row for tok in example_ids]
+        labels = [tok for _, example_labels in row for tok in example_labels]
+        position_ids = [pos for example_ids, _ in row for pos in range(len(example_ids))]
+        pad = block_size - len(ids)
+        packed["input_ids"].append(ids + [pad_token_id] * pad)
+        packed["labels"].append(labels + [-100] * pad)
+        packed["position_ids"].append(position_ids + list(range(pad)))
+    return packed
+
+
+# Arrow caches (raw + tokenized) are keyed on the data, model and response
+# template, so edits to any of them invalidate them.
+# Bump when format_example or tokenize_with_labels change what gets cached
+TOKENIZED_FORMAT_VERSION = 1
+# Unsloth may hand back a patched tokenizer, so key the two loaders apart
+tokenizer_source = "unsloth" if USE_UNSLOTH else "hf"
+with open(TRAINING_FILE, "rb") as f:
+    file_hash = hashlib.file_digest(f, "sha1")  # Reads in chunks, not the whole file
+file_hash.update(
+    f"v{TOKENIZED_FORMAT_VERSION}:{MODEL_NAME}:{tokenizer_source}:{RESPONSE_TEMPLATE}".encode()
+)
+cache_key = file_hash.hexdigest()[:12]
+cache_path = Path(TOKENIZED_DIR) / cache_key
+
+# Load data, streaming rows straight into Arrow instead of a Python list
+dataset = Dataset.from_generator(
+    load_training_data,
+    gen_kwargs={"filepath": TRAINING_FILE},
+    cache_dir=str(cache_path / "raw"),
+)
 
 print(f"✅ Loaded {len(dataset)} training examples")
-print(f"   Average text length: {sum(len(x['text']) for x in raw_data) // len(raw_data)} chars")
-print(f"   Sample preview (first 200 chars):\n   {raw_data[0]['text'][:200]}...")
+# Batched iteration reads from Arrow a slice at a time instead of loading the column
+total_chars = sum(len(text) for batch in dataset.iter(batch_size=1000) for text in batch["text"])
+print(f"   Average text length: {total_chars // len(dataset)} chars")
+print(f"   Sample preview (first 200 chars):\n   {dataset[0]['text'][:200]}...")
 
 
 # ═══════════════════════════════════════════════════════════════════════
 # CELL 4: Load Model with 4-bit Quantization
 # ═══════════════════════════════════════════════════════════════════════
 
-# 4-bit quantization config (allows training on free T4 with 16GB VRAM)
-bnb_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_quant_type="nf4",
-    bnb_4bit_compute_dtype=torch.bfloat16,
-    bnb_4bit_use_double_quant=True,
-)
-
 print(f"📥 Loading {MODEL_NAME}...")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    quantization_config=bnb_config,
-    device_map="auto",
-    trust_remote_code=True,
-)
+if USE_UNSLOTH:
+    # Unsloth quantizes to NF4 itself and handles k-bit training prep
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        MODEL_NAME,
+        max_seq_length=MAX_SEQ_LENGTH,
+        load_in_4bit=True,
+        dtype=TORCH_DTYPE,
+    )
+else:
+    # 4-bit quantization config (allows training on free T4 with 16GB VRAM)
+    bnb_config = BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=TORCH_DTYPE,  # Must match fp16/bf16 in CELL 6
+        # Double quant only saves ~65MB on 1.3B but adds a dequant pass per matmul
+        bnb_4bit_use_double_quant=False,
+    )
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        quantization_config=bnb_config,
+        torch_dtype=TORCH_DTYPE,  # Non-quantized weights (norms, embeddings)
+        attn_implementation=ATTN_IMPLEMENTATION,
+        device_map="auto",
+        trust_remote_code=True,
+    )
+
+    if USE_LIGER:
+        from liger_kernel.transformers import apply_liger_kernel_to_llama
+
+        # DeepSeek-Coder is a Llama architecture; must run before get_peft_model
+        apply_liger_kernel_to_llama(
+            rope=True,
+            rms_norm=True,
+            swiglu=True,
+            fused_linear_cross_entropy=True,
+            model=model,
+        )
 
 # Set padding token
 if tokenizer.pad_token is None:
     tokenizer.pad_token = tokenizer.eos_token
     model.config.pad_token_id = tokenizer.eos_token_id
 
-# Prepare for LoRA training
-model = prepare_model_for_kbit_training(model)
+if not USE_UNSLOTH:
+    # Prepare for LoRA training: prepare_model_for_kbit_training minus its blanket
+    # fp32 upcast, which would force per-norm casts on the bf16 path.
+    for param in model.parameters():
+        param.requires_grad = False
+    if COMPUTE_DTYPE == "fp16":
+        # fp16 norms are unstable; under bf16 they stay in the compute dtype
+        for param in model.parameters():
+            if param.ndim == 1:
+                param.data = param.data.float()
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    model.enable_input_require_grads()
 model.config.use_cache = False  # Required for gradient checkpointing
 
 print(f"✅ Model loaded: {sum(p.numel() for p in model.parameters()) / 1e6:.1f}M parameters")
+print(f"   Peak VRAM: {torch.cuda.max_memory_allocated() / 1e9:.2f} GB")
+
+# Tokenize once and cache to disk, so SFTTrainer doesn't re-tokenize every run
+tokenized_path = cache_path / "tokens"
+if tokenized_path.exists():
+    dataset = load_from_disk(str(tokenized_path))
+else:
+    dataset = dataset.map(
+        tokenize_with_labels,
+        batched=True,
+        num_proc=os.cpu_count(),
+        remove_columns=["text"],
+        fn_kwargs={"tokenizer": tokenizer},
+    )
+    dataset.save_to_disk(str(tokenized_path))
+print(f"✅ Tokenized dataset: {len(dataset)} examples ({tokenized_path})")
+
+# Packed examples are kept apart only by their restarted position_ids, which
+# only FlashAttention-2 honours; sdpa (and Unsloth's kernels) would let them
+# attend to each other, so those paths train on unpacked, padded batches.
+use_packing = PACKING and ATTN_IMPLEMENTATION == "flash_attention_2" and not USE_UNSLOTH
+if PACKING and not use_packing:
+    print("   Packing disabled: needs FlashAttention-2 without Unsloth")
+
+# Activation memory scales with sequence length, so size it to the data,
+# rounded up to a multiple of 128 for tensor cores. Packed rows can hold any
+# example, so the block only has to fit the longest one plus its EOS; unpacked
+# batches pad to their longest example, so cap those at the 95th percentile.
+# Kept separate from MAX_SEQ_LENGTH so re-running cells doesn't compound it.
+lengths = [len(ids) for ids in dataset["input_ids"]]
+if use_packing:
+    longest = max(lengths) + 1
+    block_size = min(MAX_SEQ_LENGTH, ((longest + 127) // 128) * 128)
+    print(f"   Longest example: {longest} tokens with EOS → block_size={block_size}")
+else:
+    p95 = int(np.percentile(lengths, 95))
+    block_size = min(MAX_SEQ_LENGTH, ((p95 + 127) // 128) * 128)
+    print(f"   p95 length: {p95} tokens → block_size={block_size}")
+
+# Truncating the longer examples would cut off their (labelled) response, so
+# drop them instead. Packing appends an EOS, which must fit in the block too.
+max_example_length = block_size - 1 if use_packing else block_size
+# Records without an assistant turn have no labels at all (an all -100 batch
+# gives a NaN loss), so drop those as well.
+dataset = dataset.filter(
+    lambda example: len(example["input_ids"]) <= max_example_length
+    and any(label != -100 for label in example["labels"])
+)
+print(f"   Kept {len(dataset)}/{len(lengths)} examples of ≤{max_example_length} tokens")
+if len(dataset) == 0:
+    raise ValueError(
+        f"No training examples left: all are over {max_example_length} tokens "
+        f"or have no {RESPONSE_TEMPLATE!r} turn"
+    )
+
+if use_packing:
+    # One batch over the whole dataset so rows draw from all examples
+    dataset = dataset.map(
+        pack_sequences,
+        batched=True,
+        batch_size=None,
+        remove_columns=dataset.column_names,
+        fn_kwargs={
+            "eos_token_id": tokenizer.eos_token_id,
+            "pad_token_id": tokenizer.pad_token_id,
+            "block_size": block_size,
+        },
+    )
+    print(f"   Packed into {len(dataset)} blocks of {block_size} tokens")
 
 
 # ═══════════════════════════════════════════════════════════════════════
 # CELL 5: Configure LoRA
 # ═══════════════════════════════════════════════════════════════════════
 
-lora_config = LoraConfig(
-    r=LORA_R,
-    lora_alpha=LORA_ALPHA,
-    lora_dropout=LORA_DROPOUT,
-    bias="none",
-    task_type="CAUSAL_LM",
-    target_modules=[
-        "q_proj", "k_proj", "v_proj", "o_proj",
-        "gate_proj", "up_proj", "down_proj",
-    ],
-)
+LORA_TARGET_MODULES = [
+    "q_proj", "k_proj", "v_proj", "o_proj",
+    "gate_proj", "up_proj", "down_proj",
+]
+
+if USE_UNSLOTH:
+    # "unsloth" checkpointing offloads activations to CPU asynchronously
+    model = FastLanguageModel.get_peft_model(
+        model,
+        r=LORA_R,
+        lora_alpha=LORA_ALPHA,
+        lora_dropout=LORA_DROPOUT,
+        bias="none",
+        target_modules=LORA_TARGET_MODULES,
+        use_gradient_checkpointing="unsloth",
+    )
+else:
+    lora_config = LoraConfig(
+        r=LORA_R,
+        lora_alpha=LORA_ALPHA,
+        lora_dropout=LORA_DROPOUT,
+        bias="none",
+        task_type="CAUSAL_LM",
+        target_modules=LORA_TARGET_MODULES,
+    )
+    model = get_peft_model(model, lora_config)
 
-model = get_peft_model(model, lora_config)
+compile_model = USE_TORCH_COMPILE and not USE_UNSLOTH
+if compile_model:
+    torch._dynamo.config.cache_size_limit = 64
+    # Fall back to eager for any region Dynamo can't trace (e.g. bnb 4-bit ops)
+    torch._dynamo.config.suppress_errors = True
 
 trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
 total_params = sum(p.numel() for p in model.parameters())
@@ -163,6 +423,35 @@ print(f"   Total: {total_params / 1e6:.1f}M")
 # CELL 6: Train!
 # ═══════════════════════════════════════════════════════════════════════
 
+# The LoRA-only optimizer state is small, so keep it resident in VRAM. Prefer
+# fused fp32 AdamW (8 bytes/param of state, one kernel per param group), then
+# 8-bit AdamW (2 bytes/param); page it through unified memory only when even
+# that would crowd out activations.
+free_vram, _ = torch.cuda.mem_get_info()
+state_budget = 0.5 * free_vram
+fused_ok = "fused" in inspect.signature(torch.optim.AdamW).parameters
+if fused_ok and trainable_params * 8 <= state_budget:
+    optimizer_name = "adamw_torch_fused"
+elif trainable_params * 2 <= state_budget:
+    optimizer_name = "adamw_8bit"
+else:
+    optimizer_name = "paged_adamw_8bit"
+print(f"⚙️  Optimizer: {optimizer_name} ({free_vram / 1e9:.1f} GB VRAM free)")
+
+if use_packing:
+    # Packed rows are already block_size long; padding them would add an
+    # attention_mask and lose the per-example position_ids boundaries.
+    data_collator = default_data_collator
+else:
+    # Keeps the completion-only labels from CELL 4 (the default LM collator
+    # would overwrite them with input_ids). A compiled graph is specialized on
+    # sequence length, so pad every batch to block_size to avoid recompiling.
+    data_collator = DataCollatorForSeq2Seq(
+        tokenizer,
+        label_pad_token_id=-100,
+        pad_to_multiple_of=block_size if compile_model else None,
+    )
+
 training_args = TrainingArguments(
     output_dir=OUTPUT_DIR,
     num_train_epochs=EPOCHS,
@@ -173,14 +462,26 @@ training_args = TrainingArguments(
     warmup_ratio=0.1,
     lr_scheduler_type="cosine",
     logging_steps=5,
-    save_strategy="epoch",
-    save_total_limit=2,
-    fp16=True,
-    gradient_checkpointing=True,
-    optim="paged_adamw_8bit",
+    # No per-epoch checkpoints (they'd also dump optimizer state to Colab's slow
+    # disk); CELL 7 saves the adapter once at the end.
+    save_strategy="no",
+    save_safetensors=True,
+    fp16=COMPUTE_DTYPE == "fp16",
+    bf16=COMPUTE_DTYPE == "bf16",
+    gradient_checkpointing=not USE_UNSLOTH,  # Unsloth enables its own in CELL 5
+    gradient_checkpointing_kwargs={"use_reentrant": False},  # Lower peak memory
+    optim=optimizer_name,
     max_grad_norm=0.3,
+    remove_unused_columns=False,  # Keep position_ids of packed rows
+    torch_compile=compile_model,
+    torch_compile_mode="reduce-overhead",
     report_to="none",  # Change to "wandb" if you want logging
-    dataloader_pin_memory=False,
+    # Pinned host memory enables async host→device copies; workers prepare the
+    # next batch while the GPU runs the current step.
+    dataloader_pin_memory=True,
+    dataloader_num_workers=2,
+    dataloader_persistent_workers=True,
+    dataloader_prefetch_factor=2,
 )
 
 trainer = SFTTrainer(
@@ -188,11 +489,17 @@ trainer = SFTTrainer(
     tokenizer=tokenizer,
     train_dataset=dataset,
     args=training_args,
-    max_seq_length=MAX_SEQ_LENGTH,
-    dataset_text_field="text",
-    packing=False,
+    data_collator=data_collator,
+    max_seq_length=block_size,
+    dataset_text_field=None,
+    dataset_kwargs={"skip_prepare_dataset": True},  # Already tokenized in CELL 4
+    packing=False,  # Already packed in CELL 4 (TRL's packing needs raw text)
 )
 
+# Collate directly: a second DataLoader would spawn its own persistent workers
+sample_batch = data_collator([dataset[0]])
+print(f"   Batch input_ids shape: {tuple(sample_batch['input_ids'].shape)}")
+
 print("🚀 Starting training...")
 print(f"   Steps per epoch: {len(dataset) // (BATCH_SIZE * GRADIENT_ACCUM)}")
 print(f"   Total steps: ~{EPOCHS * len(dataset) // (BATCH_SIZE * GRADIENT_ACCUM)}")
@@ -215,25 +522,87 @@ print(f"✅ LoRA adapter saved to {OUTPUT_DIR}")
 # CELL 8: Merge & Export Full Model
 # ═══════════════════════════════════════════════════════════════════════
 
-from peft import PeftModel
-
-# Reload base model in full precision for merging
-print("📥 Reloading base model for merging...")
-base_model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    torch_dtype=torch.float16,
-    device_map="auto",
-    trust_remote_code=True,
-)
-
-# Load and merge LoRA
-merged_model = PeftModel.from_pretrained(base_model, OUTPUT_DIR)
-merged_model = merged_model.merge_and_unload()
-
-# Save merged model
-merged_model.save_pretrained(MERGED_DIR)
-tokenizer.save_pretrained(MERGED_DIR)
-print(f"✅ Merged model saved to {MERGED_DIR}")
+# Only runs with EXPORT_MODE = "merged"; adapter mode exports the LoRA directly.
+
+import gc
+from peft import get_peft_model_state_dict, set_peft_model_state_dict
+
+
+def dequantize_4bit_linears(model, dtype):
+    """Replace every bnb Linear4bit in model with an nn.Linear of its dequantized weight.
+
+    Layers are swapped one at a time and nothing else holds on to the old
+    module, so each 4-bit weight is freed as soon as its fp16 copy exists and
+    peak memory stays close to the size of the fp16 model alone.
+    """
+    import bitsandbytes as bnb
+
+    names = [name for name, module in model.named_modules() if isinstance(module, bnb.nn.Linear4bit)]
+    for name in names:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        child = getattr(parent, child_name)
+        weight = bnb.functional.dequantize_4bit(child.weight.data, child.weight.quant_state)
+        # Built on the meta device so no weight is allocated or initialized
+        # before the dequantized one is assigned
+        linear = torch.nn.Linear(
+            child.in_features,
+            child.out_features,
+            bias=child.bias is not None,
+            device="meta",
+        )
+        linear.weight = torch.nn.Parameter(weight.to(dtype), requires_grad=False)
+        if child.bias is not None:
+            linear.bias = torch.nn.Parameter(child.bias.data.to(dtype), requires_grad=False)
+        setattr(parent, child_name, linear)
+        del child, weight
+    torch.cuda.empty_cache()
+
+    # Drop the quantization markers (as HfQuantizer.dequantize does) so .to()
+    # and save_pretrained treat it as a plain fp16 model
+    for attr in ("quantization_config", "_pre_quantization_dtype"):
+        if hasattr(model.config, attr):
+            delattr(model.config, attr)
+    if hasattr(model, "quantization_method"):
+        del model.quantization_method
+    model.is_quantized = False
+    model.is_loaded_in_4bit = False
+    model.hf_quantizer = None
+    return model
+
+
+if EXPORT_MODE == "merged":
+    # Merge into the model that's already in memory instead of reloading the fp16
+    # base: detach the trained adapter, dequantize the 4-bit base layer by layer
+    # (small enough peak for the 6.7B alternative on a 16GB T4), then re-attach
+    # the adapter and merge at full precision (merging into Linear4bit directly
+    # would re-quantize the merged weights).
+    print("🔀 Merging LoRA into the in-memory base model...")
+    peft_model = trainer.model
+    peft_config = peft_model.peft_config["default"]
+    adapter_state = get_peft_model_state_dict(peft_model)
+    base_model = peft_model.unload()
+    del trainer, peft_model, model, sample_batch
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    base_model = dequantize_4bit_linears(base_model, torch.float16)
+    base_model = base_model.to(torch.float16)  # Remaining norms and embeddings
+
+    merged_model = get_peft_model(base_model, peft_config)
+    set_peft_model_state_dict(merged_model, adapter_state)
+    merged_model = merged_model.merge_and_unload()
+    merged_model.config.use_cache = True  # Disabled for training in CELL 4
+
+    # Save merged model. The f16 GGUF from CELL 10 lands next to it, so fall back
+    # to regular disk if tmpfs can't hold two copies of the weights.
+    model_bytes = sum(p.numel() * p.element_size() for p in merged_model.parameters())
+    if MERGED_DIR.startswith("/dev/shm") and shutil.disk_usage("/dev/shm").free < 2.2 * model_bytes:
+        MERGED_DIR = "./react-testgen-merged"
+    # A single shard avoids shard stitching when the converter reads it back
+    merged_model.save_pretrained(MERGED_DIR, safe_serialization=True, max_shard_size="10GB")
+    tokenizer.save_pretrained(MERGED_DIR)
+    print(f"✅ Merged model saved to {MERGED_DIR}")
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -266,9 +635,33 @@ export function Spinner({ size = 'md', className }: { size?: string; className?:
 <|assistant|>
 """
 
-inputs = tokenizer(test_prompt, return_tensors="pt").to(merged_model.device)
+# In adapter mode, test the trained 4-bit model + LoRA directly
+test_model = merged_model if EXPORT_MODE == "merged" else trainer.model
+test_model.config.use_cache = True  # Disabled for training in CELL 4
+if USE_UNSLOTH and EXPORT_MODE != "merged":
+    FastLanguageModel.for_inference(test_model)  # Unsloth's fast generation path
+inputs = tokenizer(test_prompt, return_tensors="pt").to(test_model.device)
+
+test_model.eval()
+
+if not USE_UNSLOTH:
+    # Static KV cache is allocated once for prompt + completion, so decoding
+    # doesn't re-allocate per token. Set on the underlying transformers model,
+    # which is what PeftModel.generate ends up calling. Unsloth's patched
+    # attention only supports its own dynamic cache.
+    generation_model = test_model if EXPORT_MODE == "merged" else test_model.get_base_model()
+    generation_model.generation_config.cache_implementation = "static"
+    if compile_model:
+        # CELL 5's suppress_errors stays on, so anything Dynamo can't compile
+        # (e.g. bnb 4-bit ops on the adapter path) falls back to eager.
+        generation_model.forward = torch.compile(
+            generation_model.forward,
+            mode="reduce-overhead",
+            fullgraph=EXPORT_MODE == "merged",
+        )
+
 with torch.no_grad():
-    outputs = merged_model.generate(
+    outputs = test_model.generate(
         **inputs,
         max_new_tokens=1500,
         temperature=0.3,
@@ -290,15 +683,56 @@ print(response[:2000])
 # !pip install -q llama-cpp-python
 # !git clone --depth 1 https://github.com/ggerganov/llama.cpp.git
 # !pip install -q -r llama.cpp/requirements/requirements-convert_hf_to_gguf.txt
+# !cmake -B llama.cpp/build llama.cpp && cmake --build llama.cpp/build --target llama-quantize -j
+
+if EXPORT_MODE == "merged":
+    # convert_hf_to_gguf.py only emits f16/bf16/q8_0, so write an f16 GGUF next
+    # to the merged weights (tmpfs when available), then quantize it to Q4_K_M
+    # (good balance of quality vs size, ~0.8GB for 1.3B model).
+    f16_gguf = str(Path(MERGED_DIR).parent / "react-testgen-f16.gguf")
+    subprocess.run(
+        [sys.executable, "llama.cpp/convert_hf_to_gguf.py", MERGED_DIR, "--outfile", f16_gguf, "--outtype", "f16"],
+        check=True,
+    )
+    subprocess.run(["llama.cpp/build/bin/llama-quantize", f16_gguf, GGUF_FILE, "Q4_K_M"], check=True)
+    os.remove(f16_gguf)
+    if MERGED_DIR.startswith("/dev/shm"):
+        shutil.rmtree(MERGED_DIR)  # Free the RAM-backed copy once GGUF_FILE exists
+
+    print(f"✅ GGUF model created: {GGUF_FILE}")
+    print("📥 Download this file and use with Ollama locally:")
+    print(f"   1. Download {GGUF_FILE} from Colab files panel")
+    print("   2. Create a Modelfile (see inference/Modelfile in the project)")
+    print("   3. Run: ollama create react-testgen -f Modelfile")
+else:
+    from huggingface_hub import snapshot_download
+
+    base_dir = snapshot_download(MODEL_NAME)  # Already in HF_HOME from CELL 4
+    if not Path(BASE_GGUF_FILE).exists():
+        # Quantized once and cached; llama.cpp applies f16 LoRAs to a quantized base.
+        # Stage the f16 GGUF on tmpfs only if it fits, as CELL 8 does.
+        weight_files = [*Path(base_dir).glob("*.safetensors"), *Path(base_dir).glob("*.bin")]
+        base_bytes = sum(f.stat().st_size for f in weight_files)
+        staging_dir = Path(MERGED_DIR).parent
+        if str(staging_dir).startswith("/dev/shm") and shutil.disk_usage("/dev/shm").free < 1.1 * base_bytes:
+            staging_dir = Path(".")
+        f16_gguf = str(staging_dir / "base-f16.gguf")
+        subprocess.run(
+            [sys.executable, "llama.cpp/convert_hf_to_gguf.py", base_dir, "--outfile", f16_gguf, "--outtype", "f16"],
+            check=True,
+        )
+        subprocess.run(["llama.cpp/build/bin/llama-quantize", f16_gguf, BASE_GGUF_FILE, "Q4_K_M"], check=True)
+        os.remove(f16_gguf)
+    subprocess.run(
+        [sys.executable, "llama.cpp/convert_lora_to_gguf.py", OUTPUT_DIR, "--base", base_dir, "--outfile", ADAPTER_GGUF_FILE],
+        check=True,
+    )
 
-# Convert to GGUF Q4_K_M (good balance of quality vs size, ~0.8GB for 1.3B model)
-# !python llama.cpp/convert_hf_to_gguf.py {MERGED_DIR} --outfile react-testgen.gguf --outtype q4_k_m
-
-print("✅ GGUF model created: react-testgen.gguf")
-print("📥 Download this file and use with Ollama locally:")
-print("   1. Download react-testgen.gguf from Colab files panel")
-print("   2. Create a Modelfile (see inference/Modelfile in the project)")
-print("   3. Run: ollama create react-testgen -f Modelfile")
+    print(f"✅ GGUF files created: {BASE_GGUF_FILE} + {ADAPTER_GGUF_FILE}")
+    print("📥 Download both files and use with Ollama locally:")
+    print("   1. Download them from the Colab files panel (or Drive)")
+    print("   2. Place them next to inference/Modelfile.adapter (its FROM/ADAPTER lines expect these names)")
+    print("   3. Run: ollama create react-testgen -f Modelfile.adapter")
 
 
 # ═══════════════════════════════════════════════════════════════════════
@@ -307,9 +741,8 @@ print("   3. Run: ollama create react-testgen -f Modelfile")
 
 # Download the GGUF file (easiest method for Colab)
 # from google.colab import files
-# files.download("react-testgen.gguf")
+# files.download("react-testgen.gguf")  # EXPORT_MODE = "merged"
+# files.download("react-testgen-lora.gguf")  # EXPORT_MODE = "adapter" (base GGUF is on Drive)
 
-# Or save to Google Drive:
-# from google.colab import drive
-# drive.mount('/content/drive')
+# Or save to Google Drive (mounted in CELL 2):
 # !cp react-testgen.gguf /content/drive/MyDrive/
@@ -77,18 +77,9 @@ def load_training_data(filepath: Path) -> list[dict[str, str]]:
             if not line.strip():
                 continue
             data = json.loads(line)
-            formatted = ""
-            for msg in data["messages"]:
-                role = msg["role"]
-                content = msg["content"]
-                if role == "system":
-                    formatted += f"<|system|>\n{content}\n"
-                elif role == "user":
-                    formatted += f"<|user|>\n{content}\n"
-                elif role == "assistant":
-                    formatted += f"<|assistant|>\n{content}\n"
-            formatted += "<|end|>"
-            examples.append({"text": formatted})
+            parts = [f"<|{msg['role']}|>\n{msg['content']}\n" for msg in data["messages"]]
+            parts.append("<|end|>")
+            examples.append({"text": "".join(parts)})
 
     if not examples:
         raise ValueError(f"No training examples found in {filepath}")